@@ -0,0 +1,34 @@
+"""Add index for latest prophet model lookups.
+
+Revision ID: 2026_10_14_091512
+Revises: 2025_04_06_182032
+Create Date: 2026-10-14 09:15:12.000000
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "2026_10_14_091512"
+down_revision: Union[str, None] = "2025_04_06_182032"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Serves "WHERE model_type = ... ORDER BY created_at DESC LIMIT 1" from the
+    # index, replacing the model_type-only index
+    op.create_index(
+        "idx_prophet_models_type_created",
+        "prophet_models",
+        ["model_type", sa.text("created_at DESC")],
+        postgresql_include=["id"],
+    )
+    op.drop_index("idx_prophet_models_type")
+
+
+def downgrade() -> None:
+    op.create_index("idx_prophet_models_type", "prophet_models", ["model_type"])
+    op.drop_index("idx_prophet_models_type_created")
@@ -0,0 +1,52 @@
+import firebase_admin
+from firebase_admin import credentials, firestore
+from datetime import datetime
+from dateutil.relativedelta import relativedelta
+import logging
+
+# Initialize Firebase
+cred = credentials.Certificate("serviceAccountKey.json")
+firebase_admin.initialize_app(cred)
+
+# Ensure Firestore client is initialized
+db = firestore.client()
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+
+def backfill_prediction_expiry():
+    """
+    One-off backfill of expires_at on prediction days written before the TTL policy.
+
+    The TTL policy only removes documents that carry expires_at, so older days
+    would otherwise stay in the collection the app listens to. They get the
+    same expiry store_predictions writes, one month after last_updated; days
+    that are already older than that are removed by the next TTL sweep.
+    """
+    logging.info("Backfilling expires_at on prediction days...")
+    predictions_ref = db.collection("freespace_data").document("Hallenbad_City").collection("predictions")
+    # Firestore cannot query for a missing field, so check every day
+    docs = predictions_ref.select(["last_updated", "expires_at"]).stream()
+    bulk_writer = db.bulk_writer()
+    updated = 0
+    skipped = 0
+    try:
+        for doc in docs:
+            doc_dict = doc.to_dict()
+            if "expires_at" in doc_dict:
+                continue
+            last_updated = doc_dict.get("last_updated")
+            if not isinstance(last_updated, datetime):
+                logging.warning(f"Skipping prediction day {doc.id}: no valid last_updated ({last_updated!r})")
+                skipped += 1
+                continue
+            bulk_writer.update(doc.reference, {"expires_at": last_updated + relativedelta(months=1)})
+            updated += 1
+    finally:
+        # Flush the updates queued so far, even if the stream failed
+        bulk_writer.close()
+        logging.info(f"Backfilled expires_at on {updated} prediction days, skipped {skipped}.")
+    return updated, skipped
+
+if __name__ == "__main__":
+    backfill_prediction_expiry()
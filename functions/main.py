@@ -1,26 +1,49 @@
+from __future__ import annotations
+
 import websockets
+from websockets.protocol import State
 import json
 from firebase_admin import firestore, initialize_app
 from datetime import datetime
 import firebase_admin
 from firebase_functions import scheduler_fn
-from google.cloud.firestore import SERVER_TIMESTAMP
 import asyncio
+import functools
 import logging
 import os
+import threading
+from typing import TYPE_CHECKING
 from zoneinfo import ZoneInfo
-import time
-import requests
-import pandas as pd
 from dateutil.relativedelta import relativedelta
 
-# Simplify Firebase initialization
-if not firebase_admin._apps:
-    initialize_app()
+# pandas and requests are only used by the prediction functions and imported on
+# first use, keeping them out of the cold start of the frequent freespace fetch
+if TYPE_CHECKING:
+    import pandas as pd
+    import requests
 
-db = firestore.client()
 logging.basicConfig(level=logging.INFO)
 
+ZURICH_TZ = ZoneInfo("Europe/Zurich")
+
+# Months of history used for the daily full model fit; a year keeps every
+# holiday in the training data once
+FULL_HISTORY_MONTHS = 12
+
+
+@functools.lru_cache(maxsize=1)
+def get_db():
+    """
+    Firestore client, created on first use.
+
+    Building it sets up the gRPC channel, which is only paid by invocations that
+    touch Firestore rather than by every cold start importing this module.
+    """
+    # Simplify Firebase initialization
+    if not firebase_admin._apps:
+        initialize_app()
+    return firestore.client()
+
 
 def store_in_firestore(total_capacity: int, usage: int, freespace: int):
     try:
@@ -29,13 +52,14 @@ def store_in_firestore(total_capacity: int, usage: int, freespace: int):
         total_capacity = min(total_capacity, 200)
 
         # Use timezone-aware datetime
-        timestamp = datetime.now(ZoneInfo("Europe/Zurich"))
+        timestamp = datetime.now(ZURICH_TZ)
         # Create document ID in format: YYYY-MM-DD-HH-mm-ss
         doc_id = timestamp.strftime("%Y-%m-%d-%H-%M-%S")
 
         # Get reference to the document with timestamp-based ID
         doc_ref = (
-            db.collection("freespace_data")
+            get_db()
+            .collection("freespace_data")
             .document("Hallenbad_City")
             .collection("historical_data")
             .document(doc_id)
@@ -47,9 +71,11 @@ def store_in_firestore(total_capacity: int, usage: int, freespace: int):
                 "total_capacity": int(total_capacity),
                 "usage": int(usage),
                 "freespace": int(freespace),
+                # Without a capacity there is no meaningful percentage; 0 would
+                # read as a full pool in the training data
                 "freespace_percentage": float((freespace / total_capacity) * 100)
                 if total_capacity > 0
-                else 0,
+                else None,
                 "timestamp": timestamp,
             }
         )
@@ -59,35 +85,73 @@ def store_in_firestore(total_capacity: int, usage: int, freespace: int):
         logging.error(f"Error storing data in Firestore: {e}")
 
 
+# The WebSocket stays open between invocations on a warm instance, so the TLS
+# handshake and upgrade are only paid again once the connection was dropped.
+# A connection is bound to the loop that opened it, hence the shared loop.
+_websocket = None
+_websocket_loop = asyncio.new_event_loop()
+_websocket_lock = threading.Lock()
+
+
+async def get_websocket(uri: str):
+    global _websocket
+    if _websocket is None or _websocket.state is not State.OPEN:
+        logging.info("Connecting to WebSocket...")
+        # A dead connection is dropped, not waited on for a closing handshake
+        _websocket = await websockets.connect(uri, close_timeout=1)
+    return _websocket
+
+
+async def close_websocket():
+    global _websocket
+    if _websocket is not None:
+        websocket, _websocket = _websocket, None
+        await websocket.close()
+
+
 async def websocket_info(uri: str) -> int:
-    for attempt in range(3):
+    attempt = 0
+    while attempt < 3:
+        # The shared loop does not run between invocations, so keepalive pings
+        # go unanswered and a reused connection is usually stale by now
+        reused = _websocket is not None and _websocket.state is State.OPEN
         try:
-            logging.info(f"Connecting to WebSocket... attempt {attempt + 1}")
-            async with websockets.connect(uri) as websocket:
-                await websocket.send("all")
-                message = await websocket.recv()
-                data = json.loads(message)
-                for item in data:
-                    if item["name"] == "Hallenbad City":
-                        total_capacity = item["maxspace"]
-                        usage = item["currentfill"]
-                        freespace = item["freespace"]
-                        logging.info(
-                            f"Fetched data - Total Capacity: {total_capacity}, Usage: {usage}, Freespace: {freespace}"
-                        )
-                        store_in_firestore(total_capacity, usage, freespace)
-                        return freespace
+            websocket = await get_websocket(uri)
+            if reused:
+                pong_waiter = await websocket.ping()
+                await asyncio.wait_for(pong_waiter, timeout=2)
+            await websocket.send("all")
+            message = await asyncio.wait_for(websocket.recv(), timeout=10)
+            data = json.loads(message)
+            item = next((it for it in data if it["name"] == "Hallenbad City"), None)
+            if item is not None:
+                total_capacity = item["maxspace"]
+                usage = item["currentfill"]
+                freespace = item["freespace"]
+                logging.info(
+                    f"Fetched data - Total Capacity: {total_capacity}, Usage: {usage}, Freespace: {freespace}"
+                )
+                store_in_firestore(total_capacity, usage, freespace)
+                return freespace
         except Exception as e:
-            logging.error(f"Error fetching data (attempt {attempt + 1}): {e}")
+            # Reconnect on the next attempt
+            await close_websocket()
+            if reused:
+                # A stale connection is expected, reconnect without a retry
+                logging.info(f"Reused WebSocket no longer usable: {e!r}")
+                continue
+            logging.error(f"Error fetching data (attempt {attempt + 1}): {e!r}")
             if attempt < 2:
-                time.sleep(2)  # wait before retry
+                await asyncio.sleep(2)  # wait before retry
+        attempt += 1
     logging.error("All retry attempts failed.")
     return None
 
 
 def fetch_freespace():
     uri = "wss://badi-public.crowdmonitor.ch:9591/api"
-    freespace = asyncio.run(websocket_info(uri))
+    with _websocket_lock:
+        freespace = _websocket_loop.run_until_complete(websocket_info(uri))
     return freespace
 
 
@@ -100,13 +164,44 @@ def scheduled_fetch_freespace(event: scheduler_fn.ScheduledEvent):
 
 
 # Prediction related functions
+
+@functools.lru_cache(maxsize=1)
+def get_dbos_session() -> requests.Session:
+    """
+    HTTP session for the DBOS service, created on first use.
+
+    Keeps the connection alive between calls on a warm instance instead of a new
+    TCP and TLS handshake per request. Connection errors and 502/503 while the
+    app starts are retried, as is one dropped connection (a pooled connection
+    the server closed while idle). Repeating a request is safe: a prediction
+    stores nothing, and a repeated full fit only stores another model.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    session = requests.Session()
+    retries = Retry(
+        total=3,
+        read=1,
+        backoff_factor=0.5,
+        status_forcelist=[502, 503],
+        allowed_methods=["POST"],
+        raise_on_status=False,
+    )
+    session.mount("https://", HTTPAdapter(max_retries=retries))
+    session.mount("http://", HTTPAdapter(max_retries=retries))
+    return session
+
+
 def fetch_historical_data(full_history: bool = False) -> pd.DataFrame:
     """
     Fetch historical data from Firestore for prediction input.
 
     Args:
-        full_history: If True, fetches all historical data. If False, fetches only
-                     today's data (since midnight).
+        full_history: If True, fetches the last FULL_HISTORY_MONTHS months of
+                     historical data. If False, fetches only today's data
+                     (since midnight).
 
     Returns:
         DataFrame with columns:
@@ -115,39 +210,70 @@ def fetch_historical_data(full_history: bool = False) -> pd.DataFrame:
 
     If an error occurs or no data is found, returns an empty DataFrame.
     """
+    import pandas as pd
+
     try:
         # Get reference to collection
         collection_ref = (
-            db.collection("freespace_data")
+            get_db()
+            .collection("freespace_data")
             .document("Hallenbad_City")
             .collection("historical_data")
         )
 
-        # Apply time filter if not requesting full history
-        if not full_history:
-            # Get start of today
-            today_start = datetime.now(ZoneInfo("Europe/Zurich")).replace(
-                hour=0, minute=0, second=0, microsecond=0
-            )
-            collection_ref = collection_ref.where("timestamp", ">=", today_start)
-
-        # Get documents
-        docs = collection_ref.stream()
-        data = []
+        # Get start of today
+        today_start = datetime.now(ZURICH_TZ).replace(
+            hour=0, minute=0, second=0, microsecond=0
+        )
+        if full_history:
+            # Bound the full history to a rolling window so the daily fetch
+            # (and the fit on it) stops growing with every stored sample
+            start = today_start - relativedelta(months=FULL_HISTORY_MONTHS)
+        else:
+            start = today_start
+        collection_ref = collection_ref.where("timestamp", ">=", start)
+
+        # Get documents, transferring only the two fields used for the input
+        docs = collection_ref.select(["timestamp", "freespace_percentage"]).stream()
+        timestamps = []
+        values = []
         for doc in docs:
-            doc_dict = doc.to_dict()
-            timestamp = doc_dict["timestamp"]
-            if timestamp.tzinfo is None:
-                timestamp = timestamp.replace(tzinfo=ZoneInfo("Europe/Zurich"))
-            else:
-                timestamp = timestamp.astimezone(ZoneInfo("Europe/Zurich"))
-            data.append({"ds": timestamp, "y": doc_dict["freespace_percentage"]})
-        return pd.DataFrame(data)
+            # The snapshot's own field dict: to_dict() and get() deep-copy the
+            # (immutable) values on every call, which dominates this loop
+            doc_dict = doc._data
+            timestamps.append(doc_dict["timestamp"])
+            values.append(doc_dict["freespace_percentage"])
+
+        # Firestore returns timestamps as UTC, convert them all at once
+        ds = pd.to_datetime(timestamps, utc=True).tz_convert(ZURICH_TZ)
+        # Samples stored without a capacity carry no percentage
+        return pd.DataFrame({"ds": ds, "y": values}).dropna(subset=["y"])
     except Exception as e:
         logging.error(f"Error fetching historical data: {e}")
         return pd.DataFrame()
 
 
+def isoformat_timestamps(ds: pd.Series) -> list[str]:
+    """
+    ISO 8601 strings with UTC offset for a tz-aware datetime Series.
+
+    Same instants and offsets as calling isoformat() on every element (always
+    with microseconds), but formatted by NumPy in one pass.
+    """
+    import numpy as np
+
+    local = ds.dt.tz_localize(None).to_numpy()
+    utc = ds.dt.tz_convert(None).to_numpy()
+    offset_minutes = (local - utc) // np.timedelta64(1, "m")
+    offsets, inverse = np.unique(offset_minutes, return_inverse=True)
+    suffixes = np.array(
+        [f"{'+' if m >= 0 else '-'}{abs(m) // 60:02d}:{abs(m) % 60:02d}" for m in offsets]
+    )
+    return np.char.add(
+        np.datetime_as_string(local, unit="us"), suffixes[inverse]
+    ).tolist()
+
+
 def store_predictions(predictions_response: dict):
     """
     Store predictions in Firestore with proper timestamp handling.
@@ -170,32 +296,42 @@ def store_predictions(predictions_response: dict):
     """
     try:
         predictions_ref = (
-            db.collection("freespace_data")
+            get_db()
+            .collection("freespace_data")
             .document("Hallenbad_City")
             .collection("predictions")
         )
 
         # Extract predictions from the response
         predictions_data = predictions_response.get("predictions", {})
+        # One batch holds all days (a handful, well below Firestore's 500
+        # writes per batch), so they are written in a single commit
+        batch = get_db().batch()
         for day, prediction in predictions_data.items():
             # Convert last_updated to datetime
             last_updated = datetime.fromisoformat(prediction["last_updated"])
-            last_updated_ts = SERVER_TIMESTAMP if last_updated is None else last_updated
 
-            # Convert all prediction timestamps to datetime objects
-            processed_predictions = []
-            for pred in prediction["predictions"]:
-                pred_timestamp = datetime.fromisoformat(pred["timestamp"])
-                processed_predictions.append({**pred, "timestamp": pred_timestamp})
+            # Convert all prediction timestamps to datetime objects; the
+            # grouping by day and period is already done by the DBOS service
+            processed_predictions = [
+                {**pred, "timestamp": datetime.fromisoformat(pred["timestamp"])}
+                for pred in prediction["predictions"]
+            ]
 
             # Store predictions with datetime objects
-            predictions_ref.document(day).set(
+            batch.set(
+                predictions_ref.document(day),
                 {
-                    "last_updated": last_updated_ts,
+                    "last_updated": last_updated,
                     "predictions": processed_predictions,
                     "periods": prediction["periods"],
-                }
+                    # Firestore's TTL policy on this field removes days that
+                    # have not been refreshed for a month (older days are
+                    # covered by backfill_prediction_expiry.py)
+                    "expires_at": last_updated + relativedelta(months=1),
+                },
             )
+        batch.commit()
 
         logging.info(f"Stored predictions for {len(predictions_data)} days")
     except Exception as e:
@@ -225,13 +361,13 @@ def scheduled_run_dbos_predictions(event: scheduler_fn.ScheduledEvent):
             return
 
         payload = {
-            "timestamps": [ts.isoformat() for ts in df["ds"]],
+            "timestamps": isoformat_timestamps(df["ds"]),
             "values": df["y"].tolist(),
             "days": 5,
         }
 
         # Send request to DBOS endpoint
-        response = requests.post(dbos_url + "/predict", json=payload)
+        response = get_dbos_session().post(dbos_url + "/predict", json=payload)
         response.raise_for_status()
         prediction_response = response.json()
 
@@ -251,7 +387,8 @@ def scheduled_full_model_fit(event: scheduler_fn.ScheduledEvent):
     """
     Daily scheduled task to fit a full model using complete historical data.
 
-    Fetches all historical data and sends it to the DBOS full model training endpoint.
+    Fetches the training window of fetch_historical_data and sends it to the
+    DBOS full model training endpoint.
     This ensures the model maintains long-term patterns while avoiding concept drift.
     """
     try:
@@ -267,14 +404,14 @@ def scheduled_full_model_fit(event: scheduler_fn.ScheduledEvent):
             return
 
         payload = {
-            "timestamps": [ts.isoformat() for ts in df["ds"]],
+            "timestamps": isoformat_timestamps(df["ds"]),
             "values": df["y"].tolist(),
             "days": 5,
             "is_full_history": True,
         }
 
         # Send request to DBOS endpoint
-        response = requests.post(dbos_url + "/fit_full_model", json=payload)
+        response = get_dbos_session().post(dbos_url + "/fit_full_model", json=payload)
         response.raise_for_status()
         prediction_response = response.json()
 
@@ -286,62 +423,6 @@ def scheduled_full_model_fit(event: scheduler_fn.ScheduledEvent):
         logging.error(f"Error in full model training workflow: {e}")
 
 
-@scheduler_fn.on_schedule(
-    schedule="0 1 * * 1",  # Run at 1 AM every Monday
-    timezone="Europe/Zurich",
-)
-def scheduled_cleanup_old_predictions(event: scheduler_fn.ScheduledEvent):
-    """
-    Weekly scheduled task to clean up old prediction data.
-    
-    Deletes prediction documents that have a last_updated timestamp older than one month.
-    This helps keep the database size manageable and removes outdated predictions.
-    """
-    try:
-        # Calculate cutoff date (1 month ago)
-        cutoff_date = datetime.now(ZoneInfo("Europe/Zurich")) - relativedelta(months=1)
-        logging.info(f"Cleaning up predictions older than: {cutoff_date.isoformat()}")
-        
-        # Get reference to predictions collection
-        predictions_ref = (
-            db.collection("freespace_data")
-            .document("Hallenbad_City")
-            .collection("predictions")
-        )
-        
-        # Get all prediction documents
-        docs = predictions_ref.stream()
-        deleted_count = 0
-        
-        for doc in docs:
-            doc_data = doc.to_dict()
-            # Check if last_updated exists and is older than cutoff date
-            if "last_updated" in doc_data:
-                last_updated = doc_data["last_updated"]
-                
-                # Convert to datetime if it's a timestamp
-                if not isinstance(last_updated, datetime):
-                    try:
-                        last_updated = datetime.fromisoformat(str(last_updated))
-                    except (ValueError, TypeError):
-                        logging.warning(f"Invalid timestamp format in document: {doc.id}")
-                        continue
-                
-                # Add timezone info if missing
-                if last_updated.tzinfo is None:
-                    last_updated = last_updated.replace(tzinfo=ZoneInfo("Europe/Zurich"))
-                
-                # Delete if older than cutoff date
-                if last_updated < cutoff_date:
-                    doc.reference.delete()
-                    deleted_count += 1
-        
-        logging.info(f"Deleted {deleted_count} outdated prediction documents")
-        
-    except Exception as e:
-        logging.error(f"Error cleaning up old predictions: {e}")
-
-
 if __name__ == "__main__":
     # For local testing
     freespace = fetch_freespace()
@@ -1,7 +1,7 @@
 import firebase_admin
 from firebase_admin import credentials, firestore
 import pandas as pd
-from fbprophet import Prophet
+from prophet import Prophet
 import logging
 
 # Initialize Firebase
@@ -19,17 +19,16 @@ def fetch_historical_data():
         logging.info("Fetching historical data from Firestore...")
         collection_ref = db.collection("freespace_data").document("Hallenbad_City").collection("historical_data")
         docs = collection_ref.stream()
-        data = []
+        timestamps = []
+        values = []
         for doc in docs:
             doc_dict = doc.to_dict()
-            # Remove timezone information from the timestamp
-            timestamp = doc_dict["timestamp"].replace(tzinfo=None)
-            data.append({
-                "ds": timestamp,
-                "y": doc_dict["freespace"]
-            })
+            timestamps.append(doc_dict["timestamp"])
+            values.append(doc_dict["freespace"])
+        # Remove timezone information from all timestamps at once
+        ds = pd.to_datetime(timestamps, utc=True).tz_localize(None)
         logging.info("Historical data fetched successfully.")
-        return pd.DataFrame(data)
+        return pd.DataFrame({"ds": ds, "y": values})
     except Exception as e:
         logging.error(f"Error fetching historical data: {e}")
         return pd.DataFrame()